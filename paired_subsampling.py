@@ -5,14 +5,206 @@
     Purpose: Paired subsampling bam.
 '''
 
+import os
+import sys
+import math
+import mmap
+import tempfile
 import pysam
+import xxhash
+import numba
+import numpy as np
+import shlex
 import subprocess as sp
 from time import time
 from tqdm import tqdm
 from pathlib import Path
-from random import sample
+from itertools import islice
+from collections import deque
+from copy import copy
+from multiprocessing import Queue
+from concurrent.futures import ProcessPoolExecutor
+
+# define command templates as argv lists, one per pipeline stage, rendered with str.format.
+_NAME_SCAN_TMPL = [
+    ["samtools", "view", "-@", "{threads}", "-F", "0x900", "{bam}"],
+    ["cut", "-f1"],
+]
+_FRACTION_SUBSAMPLE_TMPL = [
+    ["samtools", "view", "-@", "{threads}", "-s", "{seed}.{fraction:06d}", "--remove-flags", "0x400", "-u", "{bam}"],
+]
+_NAME_FILTER_TMPL = [
+    ["samtools", "view", "-@", "{threads}", "-N", "{names}", "--remove-flags", "0x400", "-u", "{bam}"],
+]
+_SAMTOOLS_MARKDUP_TMPL = [
+    ["samtools", "collate", "-@", "{threads}", "-O", "-u", "-T", "{tmp}.collate", "-"],
+    ["samtools", "fixmate", "-@", "{threads}", "-m", "-u", "-", "-"],
+    ["samtools", "sort", "-@", "{threads}", "-u", "-T", "{tmp}.sort", "-"],
+    ["samtools", "markdup", "-@", "{threads}", "--write-index", "-r", "-f", "{metrics}", "-", "{deduped}"],
+]
+_GATK_STAGE_TMPL = [
+    ["samtools", "view", "-@", "{threads}", "-b", "-l", "1", "-o", "{subsampled}", "-"],
+]
+_GATK_MARKDUP_TMPL = [[
+    "singularity", "exec",
+    "-B", "/storage,/data",
+    "{sif}",
+    "gatk",
+    "--java-options", "-Xmx{xmx}",
+    "MarkDuplicatesSpark",
+    "--remove-sequencing-duplicates",
+    "-I", "{subsampled}",
+    "-O", "{deduped}",
+    "-M", "{metrics}",
+    "--",
+    "--spark-master", "local[{threads}]",
+    "--conf", "spark.executor.memory={xmx}",
+    "--conf", "spark.local.dir=/data/tmp",
+]]
+_WGS_METRICS_TMPL = [[
+    "singularity", "exec",
+    "-B", "/storage,/data",
+    "{sif}",
+    "gatk",
+    "--java-options", "-Xmx{xmx} -XX:ConcGCThreads={threads} -Djava.io.tmpdir=/data/tmp",
+    "CollectWgsMetrics",
+    "-R", "{fasta}",
+    "-I", "{deduped}",
+    "-O", "{wgs_metric}",
+]]
+
+
+def _render(template: list, **fields) -> list:
+    """Fill a command template, returning one argv list per pipeline stage."""
+    return [[token.format(**fields) for token in argv] for argv in template]
+
+
+def _format_pipeline(stages: list) -> str:
+    """Shell-quoted form of a pipeline, for logging."""
+    return " | ".join(shlex.join(argv) for argv in stages)
+
+
+def _spawn_pipeline(stages: list, stdout=None, stderr=None) -> list:
+    """
+    Start the stages of a pipeline without a shell, piping each stdout into the next stdin.
+
+    Parameters:
+    ----------
+    stages : list of list of str
+        argv of each stage.
+    stdout, stderr : optional
+        Passed to `subprocess.Popen` for the last stage's stdout and every stage's stderr.
+
+    Returns:
+    -------
+    list of subprocess.Popen
+        The started processes, in pipeline order. If a stage fails to start, the stages
+        already started are killed and reaped before the error is re-raised.
+    """
+    procs = []
+    try:
+        for n, argv in enumerate(stages):
+            procs.append(sp.Popen(
+                argv,
+                stdin=procs[-1].stdout if procs else None,
+                stdout=stdout if n == len(stages) - 1 else sp.PIPE,
+                stderr=stderr,
+                ))
+            if n:
+                procs[-2].stdout.close()  # upstream gets SIGPIPE if this stage exits early
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+            if proc.stdout:
+                proc.stdout.close()
+            proc.wait()
+        raise
+    return procs
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)  # odd multiplier deriving the second Bloom hash
+
 
 # define class
+class BloomFilter:
+    """
+    A fixed-size Bloom filter over uint64 digests, backed by a numpy bit array.
+
+    Memory is bounded by the expected capacity and error rate (~3.6 bytes per item at 1e-6),
+    independent of how many items are actually added. A false positive reports an unseen
+    item as seen. Probing and insertion happen in `reservoir_update`.
+    """
+    def __init__(self, capacity: int, error_rate: float = 1e-6) -> None:
+        """Size the bit array and number of probes for `capacity` items at `error_rate`."""
+        n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(n_bits / capacity * math.log(2)))
+        self.n_bits = np.uint64(n_bits)
+        self.bits = np.zeros((n_bits + 63) // 64, dtype=np.uint64)
+
+
+@numba.njit(cache=True)
+def reservoir_update(hashes, bits, n_bits, n_hashes, slots, i, k):
+    """
+    Feed a batch of query name digests through the Bloom filter and the reservoir.
+
+    Digests not yet in the filter (`bits`, `n_bits`, `n_hashes` of a `BloomFilter`) are
+    added to it and counted as new unique names; each new name enters a size-k reservoir
+    with probability k/i (double hashing probes, Algorithm R replacement). The reservoir
+    itself holds the names on the Python side, so only the chosen slot is reported.
+
+    Parameters:
+    ----------
+    hashes : np.ndarray
+        uint64 digests of the batch, possibly with repeats.
+    bits : np.ndarray
+        uint64 bit array of the Bloom filter, updated in place.
+    n_bits : np.uint64
+        Number of bits in the filter.
+    n_hashes : int
+        Number of probes per digest.
+    slots : np.ndarray
+        int64 array of len(hashes), set in place to the reservoir slot each name of the
+        batch replaces, or -1 if it does not enter the reservoir.
+    i : int
+        Number of unique names seen before this batch.
+    k : int
+        Reservoir size.
+
+    Returns:
+    -------
+    int
+        Number of unique names seen after this batch.
+    """
+    one = np.uint64(1)
+    slots[:] = -1
+    for b, h in enumerate(hashes):
+        step = (h * _GOLDEN) ^ (h >> np.uint64(32)) | one
+        present = True
+        pos = h % n_bits
+        for _ in range(n_hashes):
+            word = pos >> np.uint64(6)
+            mask = one << (pos & np.uint64(63))
+            if not bits[word] & mask:
+                present = False
+                bits[word] |= mask
+            pos = (pos + step % n_bits) % n_bits
+        if present:
+            continue
+        i += 1
+        if i <= k:
+            slots[b] = i - 1
+        else:
+            j = np.random.randint(0, i)
+            if j < k:
+                slots[b] = j
+    return i
+
+
+def _pin_worker(cpu_queue) -> None:
+    """Pin a worker process (and the tools it spawns) to the next free CPU group."""
+    os.sched_setaffinity(0, cpu_queue.get())
+
+
 class PairedSubsample:
     """
     A class for performing paired-end subsampling of a BAM file based on target sequencing depth.
@@ -21,47 +213,90 @@ class PairedSubsample:
     ----------
     human_base : float
         The base number for human genome (hg38).
+    gatk_xmx : str
+        JVM max heap for GATK CollectWgsMetrics.
+    mark_xmx : str
+        JVM max heap for GATK MarkDuplicatesSpark.
+    cpus : list of int or None
+        CPUs the run is pinned to; None leaves the affinity unchanged.
     
     Methods:
     -------
     calculate_target_read_number(read_len, adjust_val, target_depth, paired=True):
         Calculate the number of reads needed to achieve the target depth of sequencing.
     
-    get_unique_query_names(bam_path):
-        Get a unique list of query names from the BAM file.
+    reservoir_sample_query_names(bam_path, k, capacity, names_file, block_size=65536):
+        Sample k unique query names from the BAM file in a single pass.
+
+    subsample_by_names(bam_path, names_path, markdup_stages):
+        Keep the reads of the sampled query names with `samtools view -N` and mark duplicates.
+
+    estimate_unique_query_names(fread, paired=True):
+        Estimate the number of unique query names from the BAM index.
+
+    subsample_by_fraction(bam_path, fraction, seed, markdup_stages):
+        Subsample the BAM file by query-name hash with `samtools view -s` and mark duplicates.
+
+    markdup_command(deduped_bam, deduped_metrics, marker_tool="samtools", subsampled_bam=None, tmp_prefix=None):
+        Build the duplicate marking stages (samtools markdup, or staging for GATK MarkDuplicatesSpark).
     
     __call__(args):
         Perform the subsampling process and save the results to a new BAM file.
+
+    run_batch(args_list, max_workers=4):
+        Run the subsampling process over several samples in parallel.
     """
-    def __init__(self) -> None:
-        """Initialize with human genome base size based on hg38."""
+    def __init__(self, gatk_xmx: str = "6G", mark_xmx: str = "6G", cpus: list = None) -> None:
+        """Initialize with human genome base size based on hg38, GATK heap sizes and CPU pinning."""
         self.human_base = 3.1e9  # base number based on hg38
         self.gatk_sif = Path("/storage/images/gatk-4.6.0.0.sif")
         self.fasta_path = Path("/storage/references_and_index/hg38/fasta/Homo_sapiens_assembly38.fasta")
-        self.threads = 4
+        self.threads = len(cpus) if cpus else 4  # shared by samtools, BGZF (de)compression and Spark
+        self.gatk_xmx = gatk_xmx  # peak RSS stays well below 16G, so a smaller heap lets samples run side by side
+        self.mark_xmx = mark_xmx
+        self.cpus = cpus
+        # validate required resources once, instead of failing inside a GATK run.
+        for path in (self.gatk_sif, self.fasta_path):
+            if not path.exists():
+                raise FileNotFoundError(f"Required file not found: {path}")
 
     def run_subprocess(func):
         """
-        Decorator to run a shell command generated by the decorated function in a subprocess.
+        Decorator to run a command generated by the decorated function in a subprocess.
 
-        The decorated function must return a string that represents the shell command to be executed.
+        The decorated function must return the command as a list of argv lists, one per
+        pipeline stage; stages are chained directly, without a shell in between.
+        Output is streamed to stdout as it arrives; only the last lines are kept for error reporting.
 
         Args:
-            func (function): The function that generates the shell command.
+            func (function): The function that generates the command.
 
         Returns:
-            function: The wrapper function that executes the shell command.
+            function: The wrapper function that executes the command.
         """
         def wrapper(*args, **kwargs):
-            cmd = func(*args, **kwargs)
+            stages = func(*args, **kwargs)
+            cmd = _format_pipeline(stages)
             print(cmd)
-            proc = sp.run(cmd, shell=True, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-            if proc.returncode:
+            tail = deque(maxlen=200)  # keep only the last lines of (possibly long) tool logs
+            read_fd, write_fd = os.pipe()
+            try:
+                procs = _spawn_pipeline(stages, stdout=write_fd, stderr=write_fd)
+            except BaseException:
+                os.close(read_fd)
+                os.close(write_fd)
+                raise
+            os.close(write_fd)
+            with open(read_fd, errors="replace") as log:  # a stray non-UTF-8 byte must not abort the run
+                for line in log:
+                    sys.stdout.write(line)
+                    tail.append(line)
+            if any([proc.wait() for proc in procs]):
                 raise ChildProcessError(
                     f"Error occurred while running command: {cmd}\n"
-                    f"stdout: {proc.stdout}\nstderr: {proc.stderr}"
+                    f"output (last {len(tail)} lines):\n{''.join(tail)}"
                     )
-            return proc.stdout  # 필요 시 stdout 반환
+            return "".join(tail)  # 필요 시 마지막 출력 반환
         return wrapper
 
     def calculate_target_read_number(
@@ -96,40 +331,212 @@ class PairedSubsample:
         read_count = round((read_count * adjust_val * target_depth)/read_val)
         return read_count
 
-    @staticmethod
-    def get_unique_query_names(bam_path):
+    def reservoir_sample_query_names(self, bam_path, k: int, capacity: int, names_file, block_size: int = 65536) -> None:
         """
-        Extract unique query names from a BAM file for subsampling.
+        Sample k unique query names from a BAM file in a single pass using reservoir sampling.
+
+        Query names are streamed from `samtools view | cut -f1` so that no pysam
+        AlignedSegment has to be built just to read QNAME. Secondary and supplementary
+        alignments (0x900) are skipped since they share the query name of their primary.
+        The "already seen" check runs on 64-bit xxh3 digests against a Bloom filter sized
+        for `capacity` names, so memory stays bounded regardless of BAM size. A false
+        positive only keeps a name out of the reservoir, which is harmless for downsampling.
+        Python only hashes the names; the filter and reservoir arithmetic run batch-wise in
+        the compiled `reservoir_update`.
+
+        Names entering the reservoir are appended to a spill file next to `names_file`, and
+        each reservoir slot only holds the packed offset and length of its current name
+        (8 bytes), so no names are kept in Python. `samtools view -N` still loads all k names
+        into its own hash set, so selecting the reads costs O(k * name length) in samtools.
 
         Parameters:
         ----------
         bam_path : str
             Path to the input BAM file.
+        k : int
+            Number of unique query names to sample.
+        capacity : int
+            Expected (upper bound) number of unique query names, used to size the Bloom filter.
+        names_file : file object
+            Binary file opened for writing; receives the k sampled names, one per line.
+        block_size : int, optional
+            Number of query names hashed and checked per batch, by default 65536.
+        """
+        reservoir = np.empty(k, dtype=np.uint64)  # (spill offset << 16) | line length
+        seen = BloomFilter(capacity)
+        slots = np.empty(block_size, dtype=np.int64)
+        i = 0
+        offset = 0
+
+        stages = _render(_NAME_SCAN_TMPL, threads=self.threads, bam=bam_path)
+        print(_format_pipeline(stages))
+        procs = _spawn_pipeline(stages, stdout=sp.PIPE)
+        with tempfile.TemporaryFile(dir=Path(names_file.name).parent) as spill:
+            with procs[-1].stdout as names, tqdm(mininterval=2.0, smoothing=0) as pbar:
+                while batch := list(islice(names, block_size)):
+                    pbar.update(len(batch))
+                    hashes = np.fromiter((xxhash.xxh3_64_intdigest(line[:-1]) for line in batch), dtype=np.uint64, count=len(batch))  # strip trailing newline
+                    i = reservoir_update(hashes, seen.bits, seen.n_bits, seen.n_hashes, slots[:len(batch)], i, k)
+                    accepted = np.flatnonzero(slots[:len(batch)] >= 0)[::-1]
+                    if not len(accepted):
+                        continue
+                    # a slot may be replaced twice within one batch; only its last name counts.
+                    accepted = accepted[np.unique(slots[accepted], return_index=True)[1]]
+                    lines = [batch[b] for b in accepted.tolist()]  # keep the newline
+                    lengths = np.fromiter(map(len, lines), dtype=np.uint64, count=len(lines))
+                    starts = np.uint64(offset) + np.cumsum(lengths) - lengths
+                    reservoir[slots[accepted]] = (starts << np.uint64(16)) | lengths
+                    spill.write(b"".join(lines))
+                    offset += int(lengths.sum())
+            if any([proc.wait() for proc in procs]):
+                raise ChildProcessError(f"Error occurred while running command: {_format_pipeline(stages)}")
+
+            if i < k:
+                raise ValueError(f"Insufficient unique query names ({i}) for target read count ({k}). Exiting.")
+            if k:  # k == 0 leaves the spill file empty, and an empty file cannot be mmapped
+                # copy the surviving names out of the spill file in offset order.
+                spill.flush()
+                reservoir.sort()
+                with mmap.mmap(spill.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for start in range(0, k, block_size):
+                        packed = reservoir[start:start + block_size]
+                        starts = (packed >> np.uint64(16)).tolist()
+                        ends = (packed >> np.uint64(16)) + (packed & np.uint64(0xFFFF))
+                        names_file.writelines(mm[lo:hi] for lo, hi in zip(starts, ends.tolist()))
+        names_file.flush()
+
+    @staticmethod
+    def estimate_unique_query_names(fread, paired: bool = True) -> int:
+        """
+        Estimate the number of unique query names from the BAM index without reading records.
+
+        The mapped/unmapped counts stored in the index include secondary and supplementary
+        alignments, so this slightly overestimates the true number of unique names.
+
+        Parameters:
+        ----------
+        fread : pysam.AlignmentFile
+            Input BAM file opened for reading. Must be indexed.
+        paired : bool, optional
+            Whether the reads are paired-end, by default True.
 
         Returns:
         -------
-        list
-            A list of unique query names from the BAM file.
+        int
+            The estimated number of unique query names.
         """
-        unique_query_list = []
-        seen_query_names = set()  # Use a set for O(1) average lookup time
-        
-        with pysam.AlignmentFile(bam_path, "rb") as f:
-            for read in tqdm(f):
-                query_name = read.query_name
-                if query_name not in seen_query_names:
-                    seen_query_names.add(query_name)
-                    unique_query_list.append(query_name)
-        
-        return unique_query_list
-    
+        read_val = 2 if paired else 1
+        total_reads = fread.mapped + fread.unmapped
+        return round(total_reads / read_val)
+
     @run_subprocess
-    def mark_duplicates(self, subsampled_bam: Path, deduped_bam: Path, deduped_metrics: Path) -> str:
+    def subsample_by_fraction(self, bam_path: Path, fraction: float, seed: int, markdup_stages: list) -> list:
         """
-            Mark duplicates in the subsampled BAM file using GATK MarkDuplicatesSpark.
+            Subsample the BAM file to a fraction of its query names using `samtools view -s`
+            and stream the result straight into duplicate marking.
 
-            This method runs GATK MarkDuplicatesSpark with options to remove sequencing duplicates
-            and use Spark for parallel processing.
+            samtools decides on a hash of the query name, so mates are kept or dropped together
+            and the whole subsampling happens in one streaming pass. Duplicate flags are cleared
+            so that duplicates are re-marked on the subsampled reads.
+
+            Parameters:
+            ----------
+            bam_path : Path
+                Path to the input BAM file.
+            fraction : float
+                Fraction of query names to keep, in (0, 1).
+            seed : int
+                Seed for the query-name hash.
+            markdup_stages : list
+                Duplicate marking stages reading from stdin (see `markdup_command`).
+
+            Returns:
+            -------
+            list
+                The pipeline stages to be executed for subsampling and marking duplicates.
+        """
+        # `-s INT.FRAC` carries the fraction in the digits after the point, so keep it to
+        # exactly six non-zero digits: 0.9999995 would render as ".1000000" (10%).
+        fraction_digits = round(fraction * 1e6)
+        if not 1 <= fraction_digits <= 999999:
+            raise ValueError(f"Sampling fraction {fraction} is outside the range samtools view -s can express (1e-6 to 0.999999).")
+        return _render(
+            _FRACTION_SUBSAMPLE_TMPL,
+            threads=self.threads,
+            seed=seed,
+            fraction=fraction_digits,
+            bam=bam_path,
+        ) + markdup_stages
+
+    @run_subprocess
+    def subsample_by_names(self, bam_path: Path, names_path: Path, markdup_stages: list) -> list:
+        """
+            Keep the reads of the sampled query names using `samtools view -N` and stream the
+            result straight into duplicate marking.
+
+            The selection runs inside htslib, so no read or header goes through Python.
+            Duplicate flags are cleared so that duplicates are re-marked on the subsampled reads.
+
+            Parameters:
+            ----------
+            bam_path : Path
+                Path to the input BAM file.
+            names_path : Path
+                Path to the file with one sampled query name per line.
+            markdup_stages : list
+                Duplicate marking stages reading from stdin (see `markdup_command`).
+
+            Returns:
+            -------
+            list
+                The pipeline stages to be executed for subsampling and marking duplicates.
+        """
+        return _render(_NAME_FILTER_TMPL, threads=self.threads, names=names_path, bam=bam_path) + markdup_stages
+
+    def markdup_command(
+            self,
+            deduped_bam: Path,
+            deduped_metrics: Path,
+            marker_tool: str = "samtools",
+            subsampled_bam: Path = None,
+            tmp_prefix: Path = None
+            ) -> list:
+        """
+            Build the pipeline stages that mark and remove duplicates of a BAM stream read from stdin.
+
+            With samtools, the reads are collated, fixmated and sorted before `samtools markdup`,
+            which needs the MC/ms tags added by fixmate and coordinate-sorted input. Intermediate
+            stages pass uncompressed BAM to avoid BGZF encode/decode between them, and collate
+            and sort spill their temporary files under `tmp_prefix`.
+            With GATK, the stream is only written to `subsampled_bam` for `mark_duplicates_spark`
+            to run afterwards; it is transient, so it is written at compression level 1.
+
+            Parameters:
+            ----------
+            deduped_bam : Path
+                Path to the output BAM file where duplicates are marked and removed.
+            deduped_metrics : Path
+                Path to the output metrics file that will store duplication metrics.
+            marker_tool : str, optional
+                "samtools" or "gatk", by default "samtools".
+            subsampled_bam : Path, optional
+                Path to the transient subsampled BAM file, required for "gatk".
+            tmp_prefix : Path, optional
+                Prefix of the temporary files of samtools collate and sort, required for "samtools".
+
+            Returns:
+            -------
+            list
+                The pipeline stages to be executed for marking duplicates.
+        """
+        if marker_tool == "gatk":
+            return _render(_GATK_STAGE_TMPL, threads=self.threads, subsampled=subsampled_bam)
+        return _render(_SAMTOOLS_MARKDUP_TMPL, threads=self.threads, tmp=tmp_prefix, metrics=deduped_metrics, deduped=deduped_bam)
+
+    @run_subprocess
+    def mark_duplicates_spark(self, subsampled_bam: Path, deduped_bam: Path, deduped_metrics: Path) -> list:
+        """
+            Mark duplicates with GATK MarkDuplicatesSpark, kept as a fallback to samtools markdup.
 
             Parameters:
             ----------
@@ -142,27 +549,21 @@ class PairedSubsample:
 
             Returns:
             -------
-            str
-                The shell command to be executed for marking duplicates.
+            list
+                The command to be executed for marking duplicates.
         """
-        cmd = (
-            f"singularity exec "
-            f"-B /storage,/data "
-            f"{self.gatk_sif} "
-            f"gatk MarkDuplicatesSpark "
-            f"--remove-sequencing-duplicates "
-            f"-I {subsampled_bam} "
-            f"-O {deduped_bam} "
-            f"-M {deduped_metrics} "
-            "-- "
-            f"--spark-master local[{self.threads}] "
-            f"--conf 'spark.executor.memory=8G' "
-            f"--conf 'spark.local.dir=/data/tmp'"
+        return _render(
+            _GATK_MARKDUP_TMPL,
+            sif=self.gatk_sif,
+            xmx=self.mark_xmx,
+            subsampled=subsampled_bam,
+            deduped=deduped_bam,
+            metrics=deduped_metrics,
+            threads=self.threads,
         )
-        return cmd
 
     @run_subprocess
-    def collect_wgs_metric(self, deduped_bam: Path, wgs_metric: Path) -> str:
+    def collect_wgs_metric(self, deduped_bam: Path, wgs_metric: Path) -> list:
         """
             Collect WGS metrics from the deduplicated BAM file using GATK CollectWgsMetrics.
 
@@ -178,23 +579,19 @@ class PairedSubsample:
 
             Returns:
             -------
-            str
-                The shell command to be executed for collecting WGS metrics.
+            list
+                The command to be executed for collecting WGS metrics.
         """
-        # Construct the shell command for CollectWgsMetrics
-        cmd = (
-            f"singularity exec "
-            f"-B /storage,/data "
-            f"{self.gatk_sif} "
-            f"gatk "
-            f"--java-options "
-            f"\"-Xmx16G -XX:ConcGCThreads={self.threads} -Djava.io.tmpdir=/data/tmp\" "
-            f"CollectWgsMetrics "
-            f"-R {self.fasta_path} "
-            f"-I {deduped_bam} "
-            f"-O {wgs_metric}"
+        # Construct the command for CollectWgsMetrics
+        return _render(
+            _WGS_METRICS_TMPL,
+            sif=self.gatk_sif,
+            xmx=self.gatk_xmx,
+            threads=self.threads,
+            fasta=self.fasta_path,
+            deduped=deduped_bam,
+            wgs_metric=wgs_metric,
         )
-        return cmd
 
     def __call__(self, args) -> Path:
         """
@@ -210,6 +607,9 @@ class PairedSubsample:
         Path
             Path to the newly created subsampled BAM file.
         """
+        # pin to the given CPUs; samtools and GATK inherit the affinity.
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
         # Logging input
         start = time()
         # create output directory.
@@ -219,27 +619,42 @@ class PairedSubsample:
         print(f"Target depth: {args.target_depth}")
         target_read_count = self.calculate_target_read_number(args.read_len, args.adjust_val, args.target_depth, args.paired)
         print(f"Target-need read count: {target_read_count}")
-        # Get unique query name list.
-        unique_query_list = self.get_unique_query_names(args.bam_path)
-
-        if target_read_count > len(unique_query_list):
-            raise ValueError(f"Insufficient unique query names ({len(unique_query_list)}) for target read count ({target_read_count}). Exiting.")
-        # sampling.
-        sampled = set(sample(unique_query_list, target_read_count))
-        # save.
-        subsampled_bam_path = output_dir.joinpath(f"{sample_id}.paired-subsampled.bam")
-        with pysam.AlignmentFile(args.bam_path) as fread:
-            with pysam.AlignmentFile(subsampled_bam_path, 'wb', header=fread.header) as fwrite:
-                for read in tqdm(fread):
-                    if read.query_name in sampled:
-                        if read.flag & 0x400:
-                            read.flag &= ~0x400  # Remove the duplicate flag
-                        fwrite.write(read)
-        
-        # MarkDuplications.
+        # Subsample and MarkDuplications, streamed into the duplicate marker.
         deduped_bam_path = output_dir.joinpath(f"{sample_id}.paired-subsampled.deduped.bam")
         deduped_bam_metric_path = output_dir.joinpath(f"{sample_id}.paired-subsampled.deduped.bam.metrics.txt")
-        self.mark_duplicates(subsampled_bam_path, deduped_bam_path, deduped_bam_metric_path)
+        subsampled_bam_path = output_dir.joinpath(f"{sample_id}.paired-subsampled.bam")  # only written for gatk
+        tmp_prefix = output_dir.joinpath(f"{sample_id}.tmp")  # collate/sort spill next to the outputs, not in the cwd or /tmp
+        markdup_stages = self.markdup_command(deduped_bam_path, deduped_bam_metric_path, args.marker_tool, subsampled_bam_path, tmp_prefix)
+        # Only the BAM index is read in Python; the reads themselves stay in samtools.
+        with pysam.AlignmentFile(args.bam_path, "rb") as fread:
+            has_index = fread.has_index()
+            if has_index:
+                unique_count = self.estimate_unique_query_names(fread, args.paired)
+        if args.sampling == "fraction":
+            # approximate depth: one streaming pass in samtools.
+            if not has_index:
+                raise ValueError(f"Fraction-based sampling requires an indexed BAM: {args.bam_path}")
+            # checked before dividing: an empty but indexed BAM reports 0 names.
+            if unique_count <= target_read_count:
+                raise ValueError(f"Insufficient unique query names ({unique_count}) for target read count ({target_read_count}). Exiting.")
+            fraction = target_read_count / unique_count
+            print(f"Estimated unique query names: {unique_count}, sampling fraction: {fraction:.6f}")
+            self.subsample_by_fraction(args.bam_path, fraction, args.seed, markdup_stages)
+        else:
+            if has_index:
+                # the index estimate is an upper bound, so fail before the full name scan when it is too small.
+                if unique_count < target_read_count:
+                    raise ValueError(f"Insufficient unique query names ({unique_count}) for target read count ({target_read_count}). Exiting.")
+            else:
+                # no index: BAM records compress to ~100+ bytes each, i.e. ~200 bytes per unique
+                # pair name; one name per 100 bytes leaves ~2x headroom for the Bloom filter.
+                unique_count = args.bam_path.stat().st_size // 100
+            # sample the names into a temporary file and let samtools select their reads into the markdup pipeline.
+            with tempfile.NamedTemporaryFile(dir=output_dir, prefix=f"{sample_id}.", suffix=".query-names.txt") as names_file:
+                self.reservoir_sample_query_names(args.bam_path, target_read_count, max(unique_count, target_read_count), names_file)
+                self.subsample_by_names(args.bam_path, Path(names_file.name), markdup_stages)
+        if args.marker_tool == "gatk":
+            self.mark_duplicates_spark(subsampled_bam_path, deduped_bam_path, deduped_bam_metric_path)
 
         # CollectWGSmetrics.
         wgs_metric_path = output_dir.joinpath(f"{sample_id}.paired-subsampled.deduped.bam.wgs-metrics.txt")
@@ -247,6 +662,36 @@ class PairedSubsample:
         print(f"Elapsed time: {time()-start:.3f}s")
         pass
 
+    def run_batch(self, args_list: list, max_workers: int = 4) -> None:
+        """
+        Run the subsampling process over several samples in parallel worker processes.
+
+        Each sample runs its own GATK JVMs, so several small heaps are used concurrently
+        instead of one large heap per sample run sequentially. Every worker is pinned to its
+        own contiguous group of CPUs (taken from `cpus`, or the current affinity), and its
+        samtools/Spark thread count is set to the group size, so samples do not compete for
+        the same cores. There are never more workers than CPUs or samples.
+
+        Parameters:
+        ----------
+        args_list : list of argparse.Namespace
+            Per-sample arguments, as accepted by `__call__`.
+        max_workers : int, optional
+            Number of samples processed at the same time, by default 4; capped at the number of
+            CPUs and of samples.
+        """
+        cpus = sorted(self.cpus or os.sched_getaffinity(0))
+        max_workers = min(max_workers, len(args_list), len(cpus))
+        group_size = len(cpus) // max_workers
+        cpu_queue = Queue()
+        for n in range(max_workers):
+            cpu_queue.put(cpus[n * group_size:(n + 1) * group_size])
+        worker = copy(self)
+        worker.cpus = None  # already pinned by _pin_worker
+        worker.threads = group_size
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_pin_worker, initargs=(cpu_queue,)) as executor:
+            list(executor.map(worker, args_list))
+
 
 if __name__ == "__main__":
     import argparse
@@ -254,7 +699,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Paired-end subsampling of a BAM file based on target read depth.")
     
     # Required arguments
-    parser.add_argument("--bam_path", type=Path, help="Input BAM file path")
+    parser.add_argument("--bam_path", type=Path, nargs="+", help="Input BAM file path(s)")
     parser.add_argument("--output_dir", type=Path, help="Output directory")
 
     # Optional arguments with default values
@@ -262,11 +707,22 @@ if __name__ == "__main__":
     parser.add_argument("--adjust_val", type=float, default=1.2, help="Adjustment value for oversampling (default: 1.2)")
     parser.add_argument("--target_depth", type=float, required=True, help="Target depth of sequencing coverage (e.g., 30 for 30X coverage)")
     parser.add_argument("--paired", action="store_true", default=False, help="Whether the BAM file contains paired-end reads (default: False)")    
+    parser.add_argument("--sampling", choices=["reservoir", "fraction"], default="reservoir", help="Exact reservoir sampling of query names, or approximate hash-based `samtools view -s` sampling of an indexed BAM (default: reservoir)")
+    parser.add_argument("--marker_tool", choices=["samtools", "gatk"], default="samtools", help="Duplicate marker: samtools markdup, or GATK MarkDuplicatesSpark as fallback (default: samtools)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for fraction-based sampling (default: 0)")
+    parser.add_argument("--gatk_xmx", type=str, default="6G", help="JVM max heap for GATK CollectWgsMetrics (default: 6G)")
+    parser.add_argument("--mark_xmx", type=str, default="6G", help="JVM max heap for GATK MarkDuplicatesSpark (default: 6G)")
+    parser.add_argument("--cpus", type=int, nargs="+", default=None, help="CPU ids to pin the run to, split across workers in batch mode (default: no pinning)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of BAM files processed in parallel (default: 4)")
     args = parser.parse_args()
 
     # Instantiate and run the subsampling
-    subsampler = PairedSubsample()
-    subsampler(args)
+    subsampler = PairedSubsample(args.gatk_xmx, args.mark_xmx, args.cpus)
+    args_list = [argparse.Namespace(**{**vars(args), "bam_path": bam_path}) for bam_path in args.bam_path]
+    if len(args_list) == 1:
+        subsampler(args_list[0])
+    else:
+        subsampler.run_batch(args_list, args.workers)
 
 
 # # Run script?